@@ -1,9 +1,11 @@
-import requests
+import asyncio
+import functools
+import aiohttp
 import pandas as pd
 import time
 import os
-import re
 import traceback
+from contextlib import asynccontextmanager
 from datetime import date, timedelta
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
@@ -24,6 +26,9 @@ CONFIG = {
 
     # --- Configuración de Reporte ---
     "days_to_fetch": 15,
+    "poll_initial_delay": 1,
+    "poll_max_delay": 15,
+    "poll_max_attempts": 20,
     "temp_folder": os.getenv('TEMP_FOLDER', './temp_reports'),
 
     # --- Conexión a SQL Server ---
@@ -31,6 +36,7 @@ CONFIG = {
     "db_database": os.getenv('DB_DATABASE'),
     "db_table_name": "PayUReport",
     "db_schema": "dbo",
+    "db_staging_table": "#PayUStage",
 
     # --- Mapeo Lógico de Columnas (Estructura de la Tabla) ---
     "target_columns": [
@@ -41,6 +47,8 @@ CONFIG = {
         'Tipo de transacción', 'Estado de transacción', 'Código de respuesta',
         'Número de cuotas totales', 'Código de trazabilidad', 'id aliado'
     ],
+    "date_columns": ['Fecha de creación', 'Última actualización'],
+    "numeric_columns": ['Valor original', 'Valor procesado'],
     "unique_id_column": 'Id Transacción',
     "status_column": 'Estado de transacción'
 }
@@ -50,25 +58,33 @@ CONFIG = {
 # ==============================================================================
 
 class PayUReportDownloader:
-    def __init__(self, username, password):
+    def __init__(self, username, password, max_concurrency=5):
         self.username = username
         self.password = password
-        self.session = requests.Session()
+        self.session = None
+        # Límite de peticiones simultáneas contra la API de PayU
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.jwt_token = None
+
+    async def __aenter__(self):
         # Simulación de Navegador para evitar bloqueos
-        self.session.headers.update({
+        self.session = aiohttp.ClientSession(headers={
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
             'Origin': 'https://merchants.payulatam.com',
             'Referer': 'https://merchants.payulatam.com/'
         })
-        self.jwt_token = None
+        return self
 
-    def login(self):
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+
+    async def login(self):
         print("[AUTH] Iniciando sesión en PayU...")
         payload = {"login": self.username, "password": self.password, "captchaResponse": ""}
         try:
-            response = self.session.post(CONFIG["payu_login_url"], json=payload)
-            response.raise_for_status()
-            self.jwt_token = response.headers.get('jwt_auth')
+            async with self.semaphore, self.session.post(CONFIG["payu_login_url"], json=payload) as response:
+                response.raise_for_status()
+                self.jwt_token = response.headers.get('jwt_auth')
             if not self.jwt_token: raise ValueError("Token JWT no encontrado.")
             self.session.headers.update({
                 'Authorization': f'Bearer {self.jwt_token}', 
@@ -80,22 +96,40 @@ class PayUReportDownloader:
             print(f"   [ERROR] Login: {e}")
             return False
 
-    def switch_merchant(self):
+    async def switch_merchant(self):
         print("[AUTH] Seleccionando Merchant ID...")
         url = f"{CONFIG['payu_api_base_url']}/authorization/users/switch-merchant/{CONFIG['payu_merchant_id']}"
         payload = {"merchantId": int(CONFIG['payu_merchant_id'])}
         try:
-            response = self.session.put(url, json=payload)
-            response.raise_for_status()
+            async with self.semaphore, self.session.put(url, json=payload) as response:
+                response.raise_for_status()
             print(f"   -> Merchant {CONFIG['payu_merchant_id']} activo.")
             return True
         except Exception as e:
             print(f"   [ERROR] Switch Merchant: {e}")
             return False
 
-    def get_report(self, start_date, end_date, output_filepath):
+    async def authenticate(self):
+        if await self.login() and await self.switch_merchant():
+            return True
+        self.jwt_token = None
+        return False
+
+    @asynccontextmanager
+    async def _request(self, method, url, **kwargs):
+        # Ante un 401 (JWT expirado) se autentica de nuevo y se reintenta una sola vez
+        for attempt in range(2):
+            async with self.semaphore, self.session.request(method, url, **kwargs) as response:
+                if response.status != 401 or attempt:
+                    yield response
+                    return
+            print("   -> Sesión expirada, autenticando de nuevo...")
+            await self.authenticate()
+
+    async def get_report(self, start_date, end_date, output_filepath):
         print(f"\n[REPORT] Solicitando reporte: {start_date} al {end_date}")
-        if not self.login() or not self.switch_merchant(): return None
+        # El JWT se reutiliza entre reportes; solo se autentica si no hay sesión
+        if self.jwt_token is None and not await self.authenticate(): return None
 
         url = f"{CONFIG['payu_api_base_url']}/merchant-reports/reports/order/load-csv/{CONFIG['payu_account_id']}/es_co"
         params = {
@@ -105,23 +139,26 @@ class PayUReportDownloader:
         }
         
         try:
-            response = self.session.get(url, params=params)
-            response.raise_for_status()
-            file_name = response.text.strip('"')
+            async with self._request('GET', url, params=params) as response:
+                response.raise_for_status()
+                file_name = (await response.text()).strip('"')
             print(f"   -> Archivo en cola: {file_name}")
         except Exception as e:
             print(f"   [ERROR] Solicitud CSV: {e}"); return None
 
-        # Lógica de Polling (Esperar a que el servidor procese el CSV)
+        # Lógica de Polling con backoff exponencial (sin bloquear el event loop)
         print("[PROCESS] Esperando disponibilidad del archivo...")
         check_url = f"{CONFIG['payu_api_base_url']}/merchant-reports/reports/order/check-csv"
-        for attempt in range(20):
-            time.sleep(5)
-            response = self.session.head(check_url, params={'fileName': file_name})
-            if response.status_code == 200:
+        delay = CONFIG["poll_initial_delay"]
+        for attempt in range(CONFIG["poll_max_attempts"]):
+            await asyncio.sleep(delay)
+            async with self._request('HEAD', check_url, params={'fileName': file_name}) as response:
+                status = response.status
+            if status == 200:
                 print("   -> ¡Archivo listo para descarga!"); break
             else:
                 print(f"   -> Intento {attempt + 1}: Procesando todavía...")
+                delay = min(delay * 2, CONFIG["poll_max_delay"])
         else:
             print("   [ERROR] Tiempo de espera agotado."); return None
 
@@ -129,99 +166,110 @@ class PayUReportDownloader:
         print("[DOWNLOAD] Descargando CSV...")
         download_url = f"{CONFIG['payu_api_base_url']}/merchant-reports/reports/order/download-csv"
         try:
-            response = self.session.get(download_url, params={'fileName': file_name})
-            response.raise_for_status()
-            with open(output_filepath, 'w', encoding='utf-8') as f:
-                f.write(response.text)
+            loop = asyncio.get_running_loop()
+            async with self._request('GET', download_url, params={'fileName': file_name}) as response:
+                response.raise_for_status()
+                # Escritura en streaming de bytes crudos (memoria constante)
+                with open(output_filepath, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(1 << 20):
+                        await loop.run_in_executor(None, f.write, chunk)
             print(f"   -> Reporte guardado: {output_filepath}")
             return output_filepath
         except Exception as e:
             print(f"   [ERROR] Descarga: {e}"); return None
 
+async def fetch_report(start_date, end_date, output_filepath):
+    async with PayUReportDownloader(CONFIG["payu_user"], CONFIG["payu_pass"]) as downloader:
+        return await downloader.get_report(start_date, end_date, output_filepath)
+
 # ==============================================================================
 # --- 3. FUNCIONES DE TRANSFORMACIÓN Y CARGA A SQL (DATA ENGINEERING) ---
 # ==============================================================================
 
+_ENGINE = None
+
+def get_engine():
+    # Engine único por proceso: reutiliza el pool de conexiones y el handle del driver ODBC
+    global _ENGINE
+    if _ENGINE is None:
+        conn_str = (f"mssql+pyodbc://@{CONFIG['db_server']}/{CONFIG['db_database']}"
+                    "?driver=ODBC+Driver+17+for+SQL+Server&trusted_connection=yes")
+        _ENGINE = create_engine(conn_str, fast_executemany=True, pool_pre_ping=True, pool_size=5)
+    return _ENGINE
+
 def prepare_dataframe(df, db_columns):
     print("[TRANSFORM] Limpiando y normalizando tipos de datos...")
     df.columns = db_columns
 
     # Limpieza de espacios y formateo
-    for col in df.columns:
-        if df[col].dtype == 'object':
-            df[col] = df[col].str.strip()
+    text_cols = df.select_dtypes(include=['object', 'string']).columns
+    df[text_cols] = df[text_cols].apply(lambda s: s.str.strip())
 
-    # Mapeo para conversiones
+    # Respaldo de tipos: si un solo valor no coincide, read_csv deja la columna como texto.
+    # Se convierte con errors='coerce' para anular solo la celda inválida y nunca enviar strings a SQL.
     mapping = dict(zip(CONFIG['target_columns'], db_columns))
-
-    # Conversión de Fechas
-    for col_name in ['Fecha de creación', 'Última actualización']:
-        db_col = mapping.get(col_name)
-        if db_col in df.columns:
-            df[db_col] = pd.to_datetime(df[db_col], errors='coerce', format='%d/%m/%Y %H:%M:%S', dayfirst=True)
-
-    # Conversión de Moneda/Números
-    for col_name in ['Valor original', 'Valor procesado']:
-        db_col = mapping.get(col_name)
-        if db_col in df.columns:
-            df[db_col] = df[db_col].astype(str).str.replace(',', '.', regex=False)
-            df[db_col] = pd.to_numeric(df[db_col], errors='coerce')
-
-    # Normalización de ID como String
-    id_col = mapping.get(CONFIG['unique_id_column'])
-    if id_col in df.columns:
-        df[id_col] = df[id_col].astype(str)
+    for col_name in CONFIG['date_columns']:
+        db_col = mapping[col_name]
+        if not pd.api.types.is_datetime64_any_dtype(df[db_col]):
+            df[db_col] = pd.to_datetime(df[db_col], errors='coerce', format='%d/%m/%Y %H:%M:%S', cache=True)
+    for col_name in CONFIG['numeric_columns']:
+        db_col = mapping[col_name]
+        if not pd.api.types.is_numeric_dtype(df[db_col]):
+            df[db_col] = pd.to_numeric(df[db_col].str.replace(',', '.', regex=False), errors='coerce')
 
     return df
 
-def load_to_sql(df):
+def quote_identifier(name):
+    return '[' + name.replace(']', ']]') + ']'
+
+@functools.lru_cache(maxsize=8)
+def build_merge_sql(table_fqn, staging_table, cols, key, status):
+    # Memoizado por todos sus insumos (tabla, staging y firma de columnas); evita reconstruir el texto
+    # Identificadores escapados una sola vez por columna y reutilizados en todas las cláusulas
+    q = {c: quote_identifier(c) for c in cols}
+    set_clause = ", ".join([f'T.{q[c]} = S.{q[c]}' for c in cols if c != key])
+    insert_cols = ", ".join(q.values())
+    insert_vals = ", ".join([f'S.{q[c]}' for c in cols])
+    return (
+        f"MERGE {table_fqn} AS T USING {staging_table} AS S ON T.{q[key]} = S.{q[key]} "
+        f"WHEN MATCHED AND T.{q[status]} <> S.{q[status]} THEN UPDATE SET {set_clause} "
+        f"WHEN NOT MATCHED THEN INSERT ({insert_cols}) VALUES ({insert_vals}) "
+        "OUTPUT $action;"
+    )
+
+def load_to_sql(df, engine):
     if df.empty: return
 
     print("\n[SQL] Iniciando fase de persistencia en SQL Server...")
-    conn_str = (f"mssql+pyodbc://@{CONFIG['db_server']}/{CONFIG['db_database']}"
-                "?driver=ODBC+Driver+17+for+SQL+Server&trusted_connection=yes")
-    engine = create_engine(conn_str)
-
     db_columns = list(df.columns)
     mapping = dict(zip(CONFIG['target_columns'], db_columns))
     unique_col = mapping[CONFIG['unique_id_column']]
     status_col = mapping[CONFIG['status_column']]
-    table_fqn = f"[{CONFIG['db_schema']}].[{CONFIG['db_table_name']}]"
+    table_fqn = f"{quote_identifier(CONFIG['db_schema'])}.{quote_identifier(CONFIG['db_table_name'])}"
+    staging_table = quote_identifier(CONFIG['db_staging_table'])
 
-    # 1. Identificar registros nuevos vs actualizaciones
-    with engine.connect() as conn:
-        try:
-            existentes = pd.read_sql(f'SELECT "{unique_col}", "{status_col}" FROM {table_fqn}', conn)
-            existentes[unique_col] = existentes[unique_col].astype(str)
-        except:
-            existentes = pd.DataFrame(columns=[unique_col, status_col])
-
-    df_merged = df.merge(existentes, on=unique_col, how='left', suffixes=('', '_db'))
-    nuevos = df_merged[df_merged[f'{status_col}_db'].isna()].drop(columns=[f'{status_col}_db'])
-    actualizables = df_merged[
-        (df_merged[f'{status_col}_db'].notna()) & (df_merged[status_col] != df_merged[f'{status_col}_db'])
-    ].drop(columns=[f'{status_col}_db'])
-
-    # 2. Ejecutar transacciones
+    # Una fila por Id Transacción (hash sobre la clave): el MERGE falla si la fuente repite claves
+    df = df.drop_duplicates(subset=unique_col, keep='last')
+
+    # 1. MERGE basado en conjuntos (nuevos + cambios de estado)
+    merge_sql = build_merge_sql(table_fqn, staging_table, tuple(db_columns), unique_col, status_col)
+
+    # 2. Ejecutar transacción: carga masiva a staging + MERGE
     with engine.begin() as conn:
-        if not nuevos.empty:
-            print(f"   -> Insertando {len(nuevos)} nuevos registros...")
-            nuevos.to_sql(CONFIG['db_table_name'], con=conn, schema=CONFIG['db_schema'], if_exists='append', index=False, chunksize=500)
-
-        if not actualizables.empty:
-            print(f"   -> Actualizando {len(actualizables)} registros (cambio de estado)...")
-            # Generar consulta de UPDATE dinámica y segura (prevención de inyección)
-            update_cols = [c for c in db_columns if c != unique_col]
-            set_clause = ", ".join([f'"{c}" = :{re.sub(r"[^a-zA-Z0-9_]", "", c)}' for c in update_cols])
-            where_clause = f'"{unique_col}" = :{re.sub(r"[^a-zA-Z0-9_]", "", unique_col)}'
-            
-            update_query = text(f'UPDATE {table_fqn} SET {set_clause} WHERE {where_clause}')
-            
-            params = []
-            for record in actualizables.to_dict('records'):
-                params.append({re.sub(r'[^a-zA-Z0-9_]', '', k): v for k, v in record.items()})
-            
-            conn.execute(update_query, params)
+        print(f"   -> Cargando {len(df)} registros en tabla temporal...")
+        # Staging con el mismo esquema que la tabla destino
+        conn.exec_driver_sql(f"DROP TABLE IF EXISTS {staging_table}")
+        conn.exec_driver_sql(f"SELECT TOP 0 * INTO {staging_table} FROM {table_fqn}")
+
+        # executemany posicional sobre tuplas (sin dict por fila); NaN/NaT viajan como NULL
+        insert_cols = ", ".join(quote_identifier(c) for c in db_columns)
+        insert_sql = f"INSERT INTO {staging_table} ({insert_cols}) VALUES ({', '.join(['?'] * len(db_columns))})"
+        rows = df.astype(object).where(df.notna(), None)
+        conn.exec_driver_sql(insert_sql, list(rows.itertuples(index=False, name=None)))
+
+        acciones = [row[0] for row in conn.exec_driver_sql(merge_sql)]
+        print(f"   -> Insertados {acciones.count('INSERT')} nuevos registros.")
+        print(f"   -> Actualizados {acciones.count('UPDATE')} registros (cambio de estado).")
 
     print("[SQL] Carga finalizada con éxito.")
 
@@ -242,23 +290,34 @@ def run_pipeline():
 
     try:
         # 1. Validar esquema destino
-        conn_str = (f"mssql+pyodbc://@{CONFIG['db_server']}/{CONFIG['db_database']}"
-                    "?driver=ODBC+Driver+17+for+SQL+Server&trusted_connection=yes")
-        engine = create_engine(conn_str)
+        engine = get_engine()
         with engine.connect() as conn:
-            db_cols = list(conn.execute(text(f"SELECT TOP 0 * FROM [{CONFIG['db_schema']}].[{CONFIG['db_table_name']}]")).keys())
+            # Consulta de metadatos: no compila un SELECT sobre la tabla ni toca páginas de datos
+            db_cols = list(conn.execute(
+                text("SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS "
+                     "WHERE TABLE_SCHEMA = :s AND TABLE_NAME = :t ORDER BY ORDINAL_POSITION"),
+                {"s": CONFIG['db_schema'], "t": CONFIG['db_table_name']}
+            ).scalars())
+        if not db_cols:
+            raise ValueError(f"Tabla destino [{CONFIG['db_schema']}].[{CONFIG['db_table_name']}] no encontrada.")
 
         # 2. Descargar y procesar
-        downloader = PayUReportDownloader(CONFIG["payu_user"], CONFIG["payu_pass"])
-        if not downloader.get_report(date_from, date_to, temp_path):
+        if not asyncio.run(fetch_report(date_from, date_to, temp_path)):
             return
 
-        with open(temp_path, 'r', encoding='utf-8') as f:
-            df_raw = pd.read_csv(f, sep=';', dtype=str).dropna(how='all')
+        # Parseo tipado en una sola pasada del parser C (fechas y decimales con coma)
+        typed_cols = CONFIG['date_columns'] + CONFIG['numeric_columns']
+        text_cols = [c for c in CONFIG['target_columns'] if c not in typed_cols]
+        # usecols: las columnas del CSV que no van a la tabla no se parsean
+        df_raw = pd.read_csv(temp_path, sep=';', encoding='utf-8', usecols=CONFIG['target_columns'],
+                             dtype=dict.fromkeys(text_cols, str), decimal=',',
+                             parse_dates=CONFIG['date_columns'], date_format='%d/%m/%Y %H:%M:%S')
+        # Las líneas vacías se omiten al parsear; basta validar la columna clave
+        df_raw = df_raw[df_raw[CONFIG['unique_id_column']].notna()]
 
         if not df_raw.empty:
             df_final = prepare_dataframe(df_raw, db_cols)
-            load_to_sql(df_final)
+            load_to_sql(df_final, engine)
         else:
             print("[INFO] No se encontraron transacciones en el periodo.")
 